@@ -5,17 +5,29 @@ PDF-Designer + Filler (drag & drop + resize)
 - / -> Filler (liest/füllt AcroForm falls vorhanden)
 - /designer -> PDF als Bild + Overlay-Rechtecke (per Klick hinzufügen, per Drag verschieben, per Handle resize)
 - /build -> erzeugt NEUE fillable PDF anhand der gesetzten Felder
+- /upload nimmt neben Multipart auch die rohe PDF an (Content-Type: application/pdf, Name per ?name=)
+
+Betrieb mit mehreren Prozessen: gunicorn -w N app:app
+- PDFs und Templates liegen in UPLOAD_FOLDER, die Session enthält nur Verweise -> jeder Worker findet sie
+- jeder Prozess hat seinen eigenen _FITZ_LOCK, Seiten-Renderings verschiedener Worker laufen also parallel
+- UPLOAD_FOLDER muss für alle Worker derselbe Ordner sein, SECRET_KEY überall gleich
 """
 import io
-import os
 import json
+import os
+import hashlib
 import tempfile
+import threading
+import uuid
+from collections import OrderedDict
 from typing import Dict
 
-from flask import Flask, request, redirect, url_for, render_template_string, send_file, session, flash, jsonify
+from flask import Flask, request, redirect, url_for, render_template, send_file, session, flash, jsonify
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
 from werkzeug.utils import secure_filename
 
-from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfObject, IndirectPdfDict
+from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfObject, PdfString
 import fitz  # PyMuPDF
 from jinja2 import DictLoader
 
@@ -24,6 +36,16 @@ app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", tempfile.gettempdir())
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50 MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_CACHE_BYTES = int(os.environ.get("UPLOAD_CACHE_BYTES", 256 * 1024 * 1024))  # PDF-Bytes im Speicher, Rest von Platte
+PDF_CACHE_SIZE = int(os.environ.get("PDF_CACHE_SIZE", 32))  # Anzahl geparster PdfReader
+OUTPUT_SPOOL_SIZE = int(os.environ.get("OUTPUT_SPOOL_SIZE", 1024 * 1024))  # erzeugte PDFs bis 1 MB im RAM, größere in eine Temp-Datei
+PAGE_CACHE_SIZE = int(os.environ.get("PAGE_CACHE_SIZE", 256))  # Anzahl gerenderter Vorschaubilder
+PAGE_ZOOM = 1.5  # Vorschau im Designer; reicht für Klick-Genauigkeit
+PAGE_THUMB_ZOOM = 0.4  # Platzhalter, der sofort angezeigt wird, bis PAGE_ZOOM geladen ist
+PAGE_ZOOM_RANGE = (0.5, 3.0)  # Grenzen, wenn der Browser die Zielbreite (?w=) vorgibt
+PAGE_WIDTH_STEP = 200  # px; ?w= wird darauf aufgerundet, damit der Seiten-Cache nicht pro Fensterbreite wächst
+PAGE_MAX_WIDTH = 2000  # px; riesige Seiten (Pläne, A0) nicht unnötig groß rendern
 
 # ---------------- UI Templates ----------------
 TPL_LAYOUT = """
@@ -45,9 +67,11 @@ TPL_LAYOUT = """
       .grid { display: grid; grid-template-columns: 1fr 1fr; gap: 12px; }
       .flash { background: #fff7cc; border: 1px solid #ffe680; padding: 8px 12px; border-radius: 8px; margin-bottom: 12px; }
       .canvas-wrap { position: relative; display: inline-block; }
-      img.page { display:block; max-width: 100%; border: 1px solid #ddd; border-radius: 12px; }
-      .overlay { position:absolute; top:0; left:0; pointer-events:none; }
-      .rect { position:absolute; border: 2px dashed var(--accent); background: var(--accentBg); pointer-events:auto; }
+      img.page { display:block; max-width: 100%; height: auto; border: 1px solid #ddd; border-radius: 12px; }
+      /* Breite/Höhe setzt drawOverlays() bzw. das Feld selbst -> Layout bleibt im Element eingeschlossen.
+         Kein paint-Containment: Griff und Label ragen absichtlich über den Rand hinaus */
+      .overlay { position:absolute; top:0; left:0; pointer-events:none; contain: layout size; }
+      .rect { position:absolute; border: 2px dashed var(--accent); background: var(--accentBg); pointer-events:auto; contain: layout size; }
       .rect.selected { border-color:#ff3b30; }
       .pill { position:absolute; transform: translate(-50%, -100%); background: var(--accent); color:#fff; font-size:11px; padding:2px 6px; border-radius: 999px; white-space:nowrap; pointer-events:none;}
       .handle { position:absolute; width:10px; height:10px; right:-6px; bottom:-6px; background:#fff; border:2px solid var(--accent); border-radius:2px; cursor:nwse-resize; }
@@ -133,7 +157,10 @@ TPL_DESIGNER = """
     <div class=\"card\">
       <h3>Seite {{ i }}</h3>
       <div class=\"canvas-wrap\" id=\"wrap{{ i }}\">
-        <img class=\"page\" id=\"img{{ i }}\" src=\"{{ url_for('page_png', pageno=i) }}\" onclick=\"placeField({{ i }}, event)\" />
+        {% set pw, ph = preview_sizes[i-1] %}
+        <img class=\"page\" id=\"img{{ i }}\" width=\"{{ pw }}\" height=\"{{ ph }}\" loading=\"lazy\" decoding=\"async\"
+             src=\"{{ url_for('page_png', pageno=i, v=pdf_version, thumb=1) }}\"
+             data-fullsrc=\"{{ url_for('page_png', pageno=i, v=pdf_version) }}\" onclick=\"placeField({{ i }}, event)\" />
         <div class=\"overlay\" id=\"ov{{ i }}\"></div>
       </div>
     </div>
@@ -142,7 +169,7 @@ TPL_DESIGNER = """
   <div class=\"card\">
     <h3>Aktuelles Template ({{ template_name }})</h3>
     <div class=\"list muted mono" id=\"list\"></div>
-    <pre class=\"mono small\" id=\"templatePre\">{{ template_json }}</pre>
+    <pre class=\"mono small\" id=\"templatePre\"></pre>
     <div class=\"row\">
       <button onclick=\"undo()\">Letztes Feld entfernen</button>
       <button onclick=\"clearAll()\">Alle Felder löschen</button>
@@ -150,39 +177,66 @@ TPL_DESIGNER = """
   </div>
 
   <script>
-    const template = {{ template_json | safe }};
+    const template = {{ template | tojson }};
     let selectedId = null;
     let drag = null; // {id, mode:'move'|'resize', startX, startY, startFx, startFy, startW, startH, page}
 
-    function sx(img){ return img.width / img.naturalWidth; }
-    function sy(img){ return img.height / img.naturalHeight; }
+    // Template-Koordinaten sind PDF-Punkte (wie page_sizes), unabhängig von der Render-Auflösung der Vorschau
+    function sx(img, page){ return img.width / template.page_sizes[page-1][0]; }
+    function sy(img, page){ return img.height / template.page_sizes[page-1][1]; }
+
+    // Maßstab und Anzeigegröße je Seite; nur nach Laden/Größenänderung (ResizeObserver) neu gelesen,
+    // damit Zeichnen, Klicken und Ziehen kein Layout erzwingen
+    const geometry = {};
+    function geometryOf(page){
+      let g = geometry[page];
+      if (!g) {
+        const img = document.getElementById('img' + page);
+        g = geometry[page] = {sx: sx(img, page), sy: sy(img, page), cw: img.clientWidth, ch: img.clientHeight};
+      }
+      return g;
+    }
 
     function redraw() {
-      document.querySelectorAll('.overlay').forEach(ov => ov.innerHTML = '');
-      if (!template.fields) return;
-      for (let idx=0; idx<template.fields.length; idx++) {
-        const f = template.fields[idx];
-        const img = document.getElementById('img' + f.page);
-        const ov = document.getElementById('ov' + f.page);
-        if (!img || !ov) continue;
-        const _sx = sx(img), _sy = sy(img);
-        const left = f.x * _sx, top = f.y * _sy, w = f.w * _sx, h = f.h * _sy;
+      drawOverlays();
+      document.getElementById('templatePre').textContent = JSON.stringify(template, null, 2);
+      renderList();
+    }
+
+    function drawOverlays(only) {
+      // Erst alle Maße lesen (ein Layout-Durchlauf), dann pro Seite einmal schreiben statt Reflow pro Feld.
+      // only: optionale Menge von Seitennummern; andere Seiten bleiben unangetastet
+      const pages = {};
+      document.querySelectorAll('img.page').forEach(img => {
+        const page = parseInt(img.id.slice(3), 10);
+        if (only && !only.has(page)) return;
+        pages[page] = Object.assign({ov: document.getElementById('ov' + page), frag: document.createDocumentFragment()},
+                                    geometryOf(page));
+      });
+      (template.fields || []).forEach((f, idx) => {
+        const p = pages[f.page];
+        if (!p) return;
+        const left = f.x * p.sx, top = f.y * p.sy, w = f.w * p.sx, h = f.h * p.sy;
         const rect = document.createElement('div');
         rect.className = 'rect' + (idx===selectedId ? ' selected' : '');
-        rect.style.left = left + 'px'; rect.style.top = top + 'px'; rect.style.width = w + 'px'; rect.style.height = h + 'px';
+        rect.style.cssText = 'left:' + left + 'px;top:' + top + 'px;width:' + w + 'px;height:' + h + 'px';
         rect.dataset.id = idx; rect.dataset.page = f.page;
         rect.addEventListener('mousedown', startMove);
         const label = document.createElement('div');
-        label.className = 'pill'; label.style.left = (left + w/2) + 'px'; label.style.top = top + 'px'; label.textContent = f.name;
+        label.className = 'pill'; label.style.cssText = 'left:' + (left + w/2) + 'px;top:' + top + 'px'; label.textContent = f.name;
         label.dataset.id = idx; label.addEventListener('click', renameField);
         const handle = document.createElement('div');
         handle.className = 'handle'; handle.dataset.id = idx; handle.dataset.page = f.page;
         handle.addEventListener('mousedown', startResize);
-        ov.appendChild(rect); ov.appendChild(label); rect.appendChild(handle);
-        ov.style.width = img.clientWidth + 'px'; ov.style.height = img.clientHeight + 'px';
+        rect.appendChild(handle);
+        p.frag.append(rect, label);
+      });
+      for (const page in pages) {
+        const p = pages[page];
+        if (!p.ov) continue;
+        p.ov.style.cssText = 'width:' + p.cw + 'px;height:' + p.ch + 'px';
+        p.ov.replaceChildren(p.frag);
       }
-      document.getElementById('templatePre').textContent = JSON.stringify(template, null, 2);
-      renderList();
     }
 
     function renderList(){
@@ -200,8 +254,9 @@ TPL_DESIGNER = """
       if (drag) return;
       const img = document.getElementById('img' + pageNo);
       const rect = img.getBoundingClientRect();
-      const _sx = img.naturalWidth / img.width;
-      const _sy = img.naturalHeight / img.height;
+      const g = geometryOf(pageNo);
+      const _sx = 1 / g.sx;
+      const _sy = 1 / g.sy;
       const x = (ev.clientX - rect.left) * _sx;
       const y = (ev.clientY - rect.top) * _sy;
       const name = document.getElementById('fname').value.trim();
@@ -219,12 +274,11 @@ TPL_DESIGNER = """
       const id = parseInt(e.currentTarget.dataset.id, 10);
       const page = parseInt(e.currentTarget.dataset.page, 10);
       selectedId = id;
-      const img = document.getElementById('img' + page);
-      const rect = img.getBoundingClientRect();
-      const _sx = img.naturalWidth / img.width;
-      const _sy = img.naturalHeight / img.height;
+      const g = geometryOf(page);
+      const _sx = 1 / g.sx;
+      const _sy = 1 / g.sy;
       const f = template.fields[id];
-      drag = {id, mode:'move', startX: e.clientX, startY: e.clientY, startFx: f.x, startFy: f.y, page, _sx, _sy, rect};
+      drag = {id, mode:'move', startX: e.clientX, startY: e.clientY, startFx: f.x, startFy: f.y, page, _sx, _sy};
       window.addEventListener('mousemove', onDrag);
       window.addEventListener('mouseup', endDrag);
     }
@@ -234,19 +288,17 @@ TPL_DESIGNER = """
       const id = parseInt(e.currentTarget.dataset.id, 10);
       const page = parseInt(e.currentTarget.dataset.page, 10);
       selectedId = id;
-      const img = document.getElementById('img' + page);
       const f = template.fields[id];
-      const rect = img.getBoundingClientRect();
-      const _sx = img.naturalWidth / img.width;
-      const _sy = img.naturalHeight / img.height;
-      drag = {id, mode:'resize', startX: e.clientX, startY: e.clientY, startW: f.w, startH: f.h, page, _sx, _sy, rect};
+      const g = geometryOf(page);
+      const _sx = 1 / g.sx;
+      const _sy = 1 / g.sy;
+      drag = {id, mode:'resize', startX: e.clientX, startY: e.clientY, startW: f.w, startH: f.h, page, _sx, _sy};
       window.addEventListener('mousemove', onDrag);
       window.addEventListener('mouseup', endDrag);
     }
 
     function onDrag(e){
       if (!drag) return;
-      const img = document.getElementById('img' + drag.page);
       const f = template.fields[drag.id];
       if (drag.mode === 'move'){
         const dx = (e.clientX - drag.startX) * drag._sx;
@@ -301,8 +353,39 @@ TPL_DESIGNER = """
       else alert('Fehler beim Speichern');
     }
 
-    window.addEventListener('load', redraw);
-    window.addEventListener('resize', redraw);
+    // Erst die kleinen Platzhalter laden, danach die volle Auflösung nachziehen – nur für Seiten in
+    // Sichtweite, damit der Server nicht alle Seiten hintereinander rendert, bevor die sichtbare dran ist
+    function loadFullImages(){
+      const io = new IntersectionObserver(entries => {
+        entries.forEach(e => {
+          if (!e.isIntersecting) return;
+          const img = e.target;
+          io.unobserve(img);
+          const full = new Image();
+          full.onload = () => { img.src = full.src; };
+          // nur so viele Pixel anfordern, wie das Bild auf diesem Bildschirm wirklich belegt
+          full.src = img.dataset.fullsrc + '&w=' + Math.round(img.clientWidth * (window.devicePixelRatio || 1));
+        });
+      }, {rootMargin: '200px'});
+      document.querySelectorAll('img.page[data-fullsrc]').forEach(img => io.observe(img));
+    }
+
+    // Nur Seiten neu zeichnen, deren Bild die Größe geändert hat; mehrere Meldungen pro Frame zusammenfassen
+    let resizedPages = null;
+    const resizeObserver = new ResizeObserver(entries => {
+      if (!resizedPages) {
+        resizedPages = new Set();
+        requestAnimationFrame(() => { const only = resizedPages; resizedPages = null; drawOverlays(only); });
+      }
+      entries.forEach(e => {
+        const page = parseInt(e.target.id.slice(3), 10);
+        delete geometry[page];
+        resizedPages.add(page);
+      });
+    });
+    document.querySelectorAll('img.page').forEach(img => resizeObserver.observe(img));
+
+    window.addEventListener('load', () => { redraw(); loadFullImages(); });
   </script>
 {% endblock %}
 """
@@ -313,184 +396,487 @@ app.jinja_loader = DictLoader({
     "index.html": TPL_INDEX,
     "designer.html": TPL_DESIGNER
 })
+# Die Templates sind Modul-Strings und ändern sich zur Laufzeit nie -> keine uptodate-Prüfung pro Render
+app.jinja_env.auto_reload = False
+
+# ---------------- Upload-Speicher ----------------
+class _LRUCache(OrderedDict):
+    """Dict mit Obergrenze: der am längsten nicht benutzte Eintrag fliegt zuerst raus.
+    on_evict(value) wird für verdrängte Einträge aufgerufen (z.B. um Dokumente zu schließen).
+    Mit sizeof(value) gilt maxsize für die Summe der Größen (z.B. Bytes) statt für die Anzahl."""
+    def __init__(self, maxsize, on_evict=None, sizeof=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.on_evict = on_evict
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self:
+                self.size -= self.sizeof(super().__getitem__(key))
+            super().__setitem__(key, value)
+            self.size += self.sizeof(value)
+            self.move_to_end(key)
+            while self.size > self.maxsize:
+                _, evicted = self.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+                if self.on_evict is not None:
+                    self.on_evict(evicted)
+
+# Hochgeladene PDFs liegen unter UPLOAD_FOLDER/<sha1>.pdf, damit jeder Worker (gunicorn -w N) sie findet;
+# gleiche Inhalte liegen nur einmal dort. Im Speicher ist nur ein nach Bytes begrenzter Cache davon.
+# In der Session stehen nur id, Name und sha1 des Uploads ({"id", "name", "stem", "digest"}).
+_PDF_DATA = _LRUCache(UPLOAD_CACHE_BYTES, sizeof=len)
+# Designer-Templates liegen als UPLOAD_FOLDER/<upload-id>.template.json daneben: nicht im signierten Cookie,
+# weil sie mit jedem Feld wachsen, und nicht im Prozess, weil /save-template und /build verschiedene Worker treffen können
+# sha1 der PDF-Bytes -> geparster PdfReader; identische Uploads teilen sich einen Eintrag
+_PDF_CACHE = _LRUCache(PDF_CACHE_SIZE)
+# (sha1, seite, zoom) -> JPEG-Bytes der Designer-Vorschau
+_PAGE_CACHE = _LRUCache(PAGE_CACHE_SIZE)
+# sha1 -> offenes fitz.Document: einmal öffnen für Designer und alle Seitenvorschauen statt pro Bild.
+# Verdrängte Dokumente werden geschlossen; das passiert in _get_doc() und damit unter _FITZ_LOCK
+_DOC_CACHE = _LRUCache(PDF_CACHE_SIZE, on_evict=lambda doc: doc.close())
+# PyMuPDF ist nicht thread-safe (auch nicht über getrennte Dokumente) -> alle fitz-Aufrufe serialisieren
+_FITZ_LOCK = threading.Lock()
 
 # ---------------- Helper ----------------
+# Einmal angelegt statt PdfName('X') pro Widget; verglichen wird weiter mit ==
+_PN_TX = PdfName('Tx')
+_PN_WIDGET = PdfName('Widget')
 def _set_need_appearances(pdf):
     if not getattr(pdf.Root, 'AcroForm', None):
         pdf.Root.AcroForm = PdfDict()
     pdf.Root.AcroForm.update(PdfDict(NeedAppearances=PdfObject('true')))
 
+def _pdfstr(v):
+    """PDF-String -> str; to_unicode() entfernt die Klammern und löst Escapes/UTF-16 auf."""
+    if isinstance(v, PdfString):
+        return v.to_unicode()
+    return str(v).strip('()') if v else None
+
+def _iter_widgets(pdf):
+    """Widgets über den Feldbaum /AcroForm /Fields (/Kids rekursiv); ohne /Fields über die Seiten."""
+    root_fields = pdf.Root.AcroForm.Fields
+    if not root_fields:
+        for page in pdf.pages:
+            annots = page.Annots
+            if not annots:
+                continue
+            for annot in annots:
+                if annot.Subtype == _PN_WIDGET:
+                    yield annot
+        return
+    stack = list(reversed(root_fields))
+    seen = set()  # Zyklen in /Kids (kaputte PDFs) nicht endlos verfolgen
+    while stack:
+        node = stack.pop()
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node.Subtype == _PN_WIDGET:
+            yield node
+        kids = node.Kids
+        if kids:
+            stack.extend(reversed(kids))
+
 def _get_widgets(pdf):
     fields = {}
     if not getattr(pdf.Root, 'AcroForm', None):
         return fields, {}
-    for page in pdf.pages:
-        annots = getattr(page, 'Annots', []) or []
-        for annot in annots:
-            if annot.get('/Subtype') != PdfName('Widget'):
-                continue
-            name = (annot.get('/T') or '').strip('()') if annot.get('/T') else None
-            if not name:
-                continue
-            fields[name] = annot
+    for annot in _iter_widgets(pdf):
+        name = _pdfstr(annot.T)
+        if not name:
+            continue
+        fields[name] = annot
     return fields, {}
 
 def _field_desc(name, widget, _radio_selected):
-    ft = widget.get('/FT')
-    label = widget.get('/TU') or name
-    if ft == PdfName('Tx'):
-        value = widget.get('/V')
-        if value is not None:
-            value = str(value).strip('()')
+    ft = widget.FT
+    label = _pdfstr(widget.TU) or name
+    if ft == _PN_TX:
+        value = _pdfstr(widget.V)
         return dict(type='text', name=name, label=label, value=value)
     return dict(type='text', name=name, label=label, value=None)
 
+def _read_raw_upload():
+    """Rohe PDF im Request-Body (Content-Type: application/pdf), z.B. `curl --data-binary @f.pdf`.
+    Spart das Multipart-Parsing; der Dateiname kommt aus ?name=. Liefert wie _read_upload()."""
+    hasher = hashlib.sha1()
+    received = False
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                hasher.update(chunk)
+                received = True
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if not received:
+        os.unlink(tmp_path)
+        return None, None, None
+    filename = secure_filename(request.args.get('name', '')) or 'upload.pdf'
+    return filename, tmp_path, hasher.hexdigest()
+
+def _read_upload(field):
+    """Schreibt die Datei aus dem Multipart-Feld `field` blockweise in eine Temp-Datei in UPLOAD_FOLDER,
+    ohne den Body im Speicher zu sammeln. Umgeht request.files (werkzeug.formparser).
+    MAX_CONTENT_LENGTH erzwingt request.stream selbst (413). Der sha1 wird beim Empfang mitgerechnet.
+    Liefert (dateiname, temp-pfad, sha1) oder (None, None, None); den Temp-Pfad übernimmt _store_pdf()."""
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype == 'application/pdf':
+        return _read_raw_upload()
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return None, None, None
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    filename = None
+    hasher = hashlib.sha1()
+    writing = False
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+                event = decoder.next_event()
+                while not isinstance(event, (NeedData, Epilogue)):
+                    if isinstance(event, File) and event.name == field and event.filename and filename is None:
+                        filename = secure_filename(event.filename) or 'upload.pdf'
+                        writing = True
+                    elif isinstance(event, (File, Field)):
+                        writing = False
+                    elif isinstance(event, Data) and writing:
+                        out.write(event.data)
+                        hasher.update(event.data)
+                    event = decoder.next_event()
+                if not chunk:
+                    break
+    except ValueError:
+        filename = None  # kaputter Multipart-Body
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if filename is None:
+        os.unlink(tmp_path)
+        return None, None, None
+    return filename, tmp_path, hasher.hexdigest()
+
+def _get_pdf(upload, data=None):
+    """Geparster PdfReader zum Upload, aus dem Cache statt bei jedem Request neu geparst.
+    `data` übergibt /upload, solange die Bytes noch nicht abgelegt sind.
+    Der Reader wird geteilt und pdfrw-Objekte lassen sich nicht deepcopy'en: Änderungen nur
+    unter pdf.lock per _update() vornehmen und nach dem Schreiben per _restore() zurückrollen.
+    Die Feldliste (pdf.fields_render) entsteht einmal pro Dateiinhalt; gleiche Uploads teilen sie."""
+    pdf = _PDF_CACHE.get(upload['digest'])
+    if pdf is None:
+        pdf = PdfReader(fdata=data if data is not None else _pdf_data(upload['digest']))
+        pdf.private.lock = threading.Lock()
+        _set_need_appearances(pdf)
+        widgets, radio_selected = _get_widgets(pdf)
+        pdf.private.widgets = widgets
+        pdf.private.fields_render = [_field_desc(name, w, radio_selected) for name, w in widgets.items()]
+        _PDF_CACHE[upload['digest']] = pdf
+    return pdf
+
+def _get_doc(upload):
+    """Offenes fitz.Document zum Upload; nur unter _FITZ_LOCK benutzen."""
+    doc = _DOC_CACHE.get(upload['digest'])
+    if doc is None:
+        doc = fitz.open(stream=_pdf_data(upload['digest']), filetype="pdf")
+        _DOC_CACHE[upload['digest']] = doc
+    return doc
+
+def _preview_zoom(page_w, zoom):
+    # riesige Seiten (Pläne, A0) auf PAGE_MAX_WIDTH begrenzen
+    return min(zoom, PAGE_MAX_WIDTH / page_w)
+
+def _render_page(upload, pageno, zoom, width=None):
+    """JPEG der Seite; mit `width` (px) wird der Zoom aus der Seitenbreite bestimmt statt `zoom` zu nehmen."""
+    key = (upload['digest'], pageno, zoom, width)
+    img_bytes = _PAGE_CACHE.get(key)
+    if img_bytes is None:
+        with _FITZ_LOCK:
+            doc = _get_doc(upload)
+            if pageno < 1 or pageno > len(doc):
+                return None
+            page = doc[pageno-1]
+            if width:
+                lo, hi = PAGE_ZOOM_RANGE
+                zoom = min(max(width / page.rect.width, lo), hi)
+            zoom = _preview_zoom(page.rect.width, zoom)
+            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
+            img_bytes = pix.tobytes("jpeg", jpg_quality=80)
+        _PAGE_CACHE[key] = img_bytes
+    return img_bytes
+
+def _field_rects(fields):
+    # Designer und fitz rechnen beide oben-links mit y nach unten -> keine Umrechnung nötig; eine Liste pro Seite
+    return [fitz.Rect(x, y, x + w, y + h)
+            for x, y, w, h in ((float(f["x"]), float(f["y"]), float(f["w"]), float(f["h"])) for f in fields)]
+
+def _update(obj, saved, entries):
+    # entries ist ein fertiges PdfDict; alte Rohwerte nur dieser Keys merken, _restore() spielt sie rückwärts zurück
+    saved.append((obj, {key: dict.get(obj, key) for key in entries}))
+    obj.update(entries)
+
+def _restore(saved):
+    for obj, old in reversed(saved):
+        for key, value in old.items():
+            if value is None:
+                dict.pop(obj, key, None)
+            else:
+                dict.__setitem__(obj, key, value)
+
+def _upload_path(digest):
+    return os.path.join(app.config['UPLOAD_FOLDER'], digest + '.pdf')
+
+def _write_atomic(path, data):
+    # erst Temp-Datei im selben Ordner, dann atomar umbenennen: andere Worker sehen nie eine halbe Datei
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+def _store_pdf(digest, tmp_path, data):
+    """Benennt die empfangene Temp-Datei atomar in UPLOAD_FOLDER/<sha1>.pdf um und legt die Bytes in den Cache.
+    Gibt es die Datei schon (gleicher Inhalt), wird sie einfach ersetzt; andere Worker sehen nie eine halbe Datei."""
+    os.replace(tmp_path, _upload_path(digest))
+    _PDF_DATA[digest] = data
+
+def _pdf_data(digest):
+    """PDF-Bytes zum sha1: aus dem Speicher oder, z.B. im anderen Worker hochgeladen, von Platte."""
+    data = _PDF_DATA.get(digest)
+    if data is None:
+        with open(_upload_path(digest), 'rb') as f:
+            data = f.read()
+        _PDF_DATA[digest] = data
+    return data
+
 def _ensure_upload():
-    pdf_path = session.get('pdf_path')
-    if not pdf_path or not os.path.exists(pdf_path):
+    upload = session.get('upload')
+    if not upload:
         return None
-    return pdf_path
+    if upload['digest'] not in _PDF_DATA and not os.path.exists(_upload_path(upload['digest'])):
+        return None  # Datei wurde aus UPLOAD_FOLDER entfernt
+    return upload
+
+def _template_path(upload):
+    return os.path.join(app.config['UPLOAD_FOLDER'], upload['id'] + '.template.json')
+
+def _get_template(upload):
+    try:
+        with open(_template_path(upload), 'rb') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+def _set_template(upload, tmpl):
+    _write_atomic(_template_path(upload), json.dumps(tmpl).encode('utf-8'))
 
 # ---------------- Routes: Filler ----------------
 @app.route('/')
 def index():
-    fields = session.get('fields_render', [])
-    pdf_name = os.path.basename(session.get('pdf_path')) if session.get('pdf_path') else None
-    return render_template_string(TPL_INDEX, fields=fields, pdf_name=pdf_name)
+    upload = _ensure_upload()
+    fields = _get_pdf(upload).fields_render if upload else []
+    pdf_name = upload['name'] if upload else None
+    return render_template('index.html', fields=fields, pdf_name=pdf_name)
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    f = request.files.get('pdf')
-    if not f or f.filename == '':
+    filename, tmp_path, digest = _read_upload('pdf')
+    if tmp_path is None:
         flash('Keine Datei ausgewählt.')
         return redirect(url_for('index'))
-    filename = secure_filename(f.filename)
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    f.save(temp_path)
-    session['pdf_path'] = temp_path
-
+    # Basis des Download-Namens einmal pro Upload statt bei jedem /fill bzw. /build
+    upload = {"id": uuid.uuid4().hex, "name": filename, "stem": os.path.splitext(filename)[0], "digest": digest}
     try:
-        pdf = PdfReader(temp_path)
+        with open(tmp_path, 'rb') as f:
+            data = f.read()
+        pdf = _get_pdf(upload, data)
     except Exception as e:
+        os.unlink(tmp_path)
         flash(f'PDF konnte nicht gelesen werden: {e}')
         return redirect(url_for('index'))
 
-    _set_need_appearances(pdf)
-    widgets, radio_selected = _get_widgets(pdf)
-    fields_render = [_field_desc(name, w, radio_selected) for name, w in widgets.items()]
-    session['fields_render'] = fields_render
+    # erst nach erfolgreichem Parsen ablegen und registrieren, sonst zeigt die Session auf einen kaputten Upload
+    _store_pdf(digest, tmp_path, data)
+    session['upload'] = upload
+    fields_render = pdf.fields_render
     flash(f"{len(fields_render)} AcroForm-Feld(er) erkannt.{'' if len(fields_render)>0 else ' (keine)'}")
     return redirect(url_for('index'))
 
 @app.route('/fill', methods=['POST'])
 def fill():
-    pdf_path = _ensure_upload()
-    if not pdf_path:
+    upload = _ensure_upload()
+    if not upload:
         flash('Sitzung abgelaufen. Bitte PDF erneut hochladen.')
         return redirect(url_for('index'))
 
-    values = dict(request.form.items())
-    pdf = PdfReader(pdf_path)
-    _set_need_appearances(pdf)
-    fields, _ = _get_widgets(pdf)
-    for name, widget in fields.items():
-        if name in values:
-            widget.update(PdfDict(V=str(values[name])))
-
-    out_io = io.BytesIO()
-    PdfWriter().write(out_io, pdf)
+    pdf = _get_pdf(upload)
+    out_io = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_SIZE)
+    with pdf.lock:
+        # NeedAppearances und Widget-Index hat _get_pdf gesetzt; gesichert wird nur das geänderte /V.
+        # Über die (wenigen) gesendeten Werte laufen statt über alle Widgets
+        saved = []
+        try:
+            for name, value in request.form.items():
+                widget = pdf.widgets.get(name)
+                if widget is None:
+                    continue
+                if _pdfstr(widget.V) == value:
+                    continue  # unverändert -> Widget nicht anfassen
+                _update(widget, saved, PdfDict(V=value))
+            PdfWriter().write(out_io, pdf)
+        finally:
+            _restore(saved)
+    size = out_io.tell()
     out_io.seek(0)
-    out_name = os.path.splitext(os.path.basename(pdf_path))[0] + "_ausgefuellt.pdf"
+    if size <= OUTPUT_SPOOL_SIZE:
+        # noch nicht ausgelagert: als BytesIO senden. Ein wsgi.file_wrapper (gunicorn) ruft sonst fileno()
+        # auf, und das schreibt die SpooledTemporaryFile doch noch auf Platte
+        out_io = io.BytesIO(out_io.read())
+    out_name = upload['stem'] + "_ausgefuellt.pdf"
     return send_file(out_io, as_attachment=True, download_name=out_name, mimetype='application/pdf')
 
 # ---------------- Routes: Designer ----------------
 @app.route('/designer')
 def designer():
-    pdf_path = _ensure_upload()
-    if not pdf_path:
+    upload = _ensure_upload()
+    if not upload:
         flash('Bitte zuerst eine PDF hochladen.')
         return redirect(url_for('index'))
-    doc = fitz.open(pdf_path)
-    tmpl = session.get('template') or {"fields": [], "page_sizes": []}
-    if not tmpl["page_sizes"]:
-        for p in doc:
-            rect = p.rect
-            tmpl["page_sizes"].append([rect.width, rect.height])
-    session['template'] = tmpl
-    return render_template_string(TPL_DESIGNER,
-                                  page_count=len(doc),
-                                  template_json=json.dumps(tmpl),
+    stored = _get_template(upload)
+    tmpl = stored or {"fields": [], "page_sizes": []}
+    with _FITZ_LOCK:
+        doc = _get_doc(upload)
+        page_count = len(doc)
+        if not tmpl["page_sizes"]:
+            for p in doc:
+                rect = p.rect
+                tmpl["page_sizes"].append([rect.width, rect.height])
+    if stored is None:
+        # nur beim ersten Aufruf schreiben; sonst überschriebe jeder GET ein parallel gespeichertes Template
+        _set_template(upload, tmpl)
+    # Anzeigegröße der vollen Vorschau vorab setzen, damit der Platzhalter gleich groß erscheint
+    preview_sizes = []
+    for w, h in tmpl["page_sizes"]:
+        zoom = _preview_zoom(w, PAGE_ZOOM)
+        preview_sizes.append((round(w * zoom), round(h * zoom)))
+    return render_template('designer.html',
+                                  page_count=page_count,
+                                  preview_sizes=preview_sizes,
+                                  pdf_version=upload['digest'][:12],
+                                  template=tmpl,
                                   template_name="session_template.json")
 
 @app.route('/page/<int:pageno>')
 def page_png(pageno: int):
-    pdf_path = _ensure_upload()
-    if not pdf_path:
+    upload = _ensure_upload()
+    if not upload:
         return "no file", 400
-    doc = fitz.open(pdf_path)
-    if pageno < 1 or pageno > len(doc):
-        return "bad page", 404
-    page = doc[pageno-1]
-    zoom = 2.0
-    mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    img_bytes = pix.tobytes("png")
-    return send_file(io.BytesIO(img_bytes), mimetype="image/png")
+    zoom = PAGE_THUMB_ZOOM if request.args.get('thumb') else PAGE_ZOOM
+    width = request.args.get('w', type=int)
+    if width:
+        # tatsächliche Anzeigebreite (inkl. devicePixelRatio) statt fester Zoomstufe, in Stufen gerundet
+        width = min(-(-width // PAGE_WIDTH_STEP) * PAGE_WIDTH_STEP, PAGE_MAX_WIDTH)
+    # ETag aus Inhalt + Seite + Zoom/Breite: bei If-None-Match gar nicht erst rendern oder im Cache nachsehen
+    etag = '{}-{}-{}-{}'.format(upload['digest'], pageno, zoom, width)
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+        resp.set_etag(etag)
+    else:
+        img_bytes = _render_page(upload, pageno, zoom, width)
+        if img_bytes is None:
+            return "bad page", 404
+        resp = send_file(io.BytesIO(img_bytes), mimetype="image/jpeg", etag=etag, conditional=True)
+    # URL enthält ?v=<sha1>, daher darf der Browser cachen; private, weil vom Session-Upload abhängig
+    resp.headers['Cache-Control'] = 'private, max-age=3600'
+    return resp
 
 @app.route('/save-template', methods=['POST'])
 def save_template():
-    data = request.get_json(force=True)
-    session['template'] = data
+    upload = _ensure_upload()
+    if not upload:
+        return jsonify({"ok": False}), 400
+    _set_template(upload, request.get_json(force=True))
     return jsonify({"ok": True})
 
 @app.route('/build', methods=['POST'])
 def build():
-    pdf_path = _ensure_upload()
-    if not pdf_path:
+    upload = _ensure_upload()
+    if not upload:
         flash('Bitte zuerst eine PDF hochladen.')
         return redirect(url_for('index'))
-    tmpl = session.get('template') or {"fields": [], "page_sizes": []}
+    tmpl = _get_template(upload) or {"fields": [], "page_sizes": []}
     if not tmpl["fields"]:
         flash("Kein Feld im Template. Im Designer per Klick Felder hinzufügen.")
         return redirect(url_for('designer'))
 
-    pdf = PdfReader(pdf_path)
-    _set_need_appearances(pdf)
-
-    for idx, page in enumerate(pdf.pages, start=1):
-        page_annots = getattr(page, 'Annots', None)
-        if page_annots is None:
-            page.Annots = page_annots = []
-
-        page_fields = [f for f in tmpl["fields"] if int(f["page"]) == idx]
-        page_w, page_h = tmpl["page_sizes"][idx-1]
-        for fld in page_fields:
-            x = float(fld["x"]); y = float(fld["y"]); w = float(fld["w"]); h = float(fld["h"])
-            pdf_y = page_h - y - h
-            rect = [x, pdf_y, x+w, pdf_y+h]
-
-            tf = IndirectPdfDict(
-                FT=PdfName('Tx'),
-                T='({})'.format(fld["name"]),
-                V='',
-                Ff=0,
-                DA='(/Helv 10 Tf 0 g)',
-                Rect=rect,
-                Subtype=PdfName('Widget'),
-                Type=PdfName('Annot'),
-                F=4
-            )
-            page_annots.append(tf)
-
-    out_io = io.BytesIO()
-    PdfWriter().write(out_io, pdf)
-    out_io.seek(0)
-    out_name = os.path.splitext(os.path.basename(pdf_path))[0] + "_fillable.pdf"
+    with _FITZ_LOCK:
+        # eigenes Dokument statt _get_doc(): das gecachte bleibt für die Vorschau unverändert
+        doc = fitz.open(stream=_pdf_data(upload['digest']), filetype="pdf")
+        try:
+            # Felder einmal nach Seite gruppieren statt pro Seite die ganze Liste zu filtern
+            fields_by_page = {}
+            for f in tmpl["fields"]:
+                fields_by_page.setdefault(int(f["page"]), []).append(f)
+            for idx, page in enumerate(doc, start=1):
+                page_fields = fields_by_page.get(idx)
+                if not page_fields:
+                    continue
+                for fld, rect in zip(page_fields, _field_rects(page_fields)):
+                    # add_widget trägt das Feld auch in /AcroForm /Fields ein und erzeugt den Appearance-Stream
+                    widget = fitz.Widget()
+                    widget.field_type = fitz.PDF_WIDGET_TYPE_TEXT
+                    widget.field_name = fld["name"]
+                    widget.field_value = ''
+                    widget.text_font = 'Helv'
+                    widget.text_fontsize = 10
+                    widget.rect = rect
+                    page.add_widget(widget)
+            # tobytes() statt save(): fitz hält die Ausgabe ohnehin in einem Puffer, BytesIO übernimmt ihn ohne Kopie
+            out_io = io.BytesIO(doc.tobytes(garbage=3, deflate=True))
+        finally:
+            doc.close()
+    out_name = upload['stem'] + "_fillable.pdf"
     return send_file(out_io, as_attachment=True, download_name=out_name, mimetype='application/pdf')
 
 @app.route('/health')
 def health():
+    # GET/HEAD beantwortet schon _health_middleware; die Route sorgt für 405 bei anderen Methoden
     return "ok", 200
 
+# Liveness-Probe direkt auf WSGI-Ebene: ohne Routing, Request-Kontext und Session-Cookie
+_HEALTH_HEADERS = [('Content-Type', 'text/plain'), ('Content-Length', '2')]
+
+def _health_middleware(wsgi_app):
+    def middleware(environ, start_response):
+        method = environ.get('REQUEST_METHOD')
+        if environ.get('PATH_INFO') == '/health' and method in ('GET', 'HEAD'):
+            start_response('200 OK', list(_HEALTH_HEADERS))  # Server dürfen die Liste erweitern
+            return [] if method == 'HEAD' else [b'ok']
+        return wsgi_app(environ, start_response)
+    return middleware
+
+app.wsgi_app = _health_middleware(app.wsgi_app)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get("PORT", 5000)))
@@ -13,19 +13,29 @@ Start:
 
 Dann im Browser öffnen: http://127.0.0.1:5000
 
+Ohne Browser (rohe PDF statt Multipart):
+  curl -c jar --data-binary @formular.pdf -H 'Content-Type: application/pdf' 'http://127.0.0.1:5000/upload?name=formular.pdf'
+
 Hinweis:
 - Funktioniert für die meisten AcroForm‑PDFs (Textfelder, Checkboxen, Radios, Dropdowns).
 - Wenn Werte im PDF nicht angezeigt werden: "NeedAppearances" wird gesetzt. Manchmal hilft zusätzliches "Flatten" (nachgelagert via Ghostscript/qpdf), siehe Kommentar unten.
 """
 
+import hashlib
 import io
 import os
 import tempfile
-from typing import Dict, List, Tuple, Optional
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Mapping, Tuple, Optional
 
-from flask import Flask, request, redirect, url_for, render_template_string, send_file, session, flash
+from flask import Flask, request, redirect, url_for, render_template, send_file, session, flash
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, Data, Epilogue, Field, File, NeedData
 from werkzeug.utils import secure_filename
-from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfObject
+from pdfrw import PdfReader, PdfWriter, PdfDict, PdfName, PdfObject, PdfString
+from pdfrw.objects.pdfname import BasePdfName
+from jinja2 import DictLoader
 
 # -------------------------
 # App‑Setup
@@ -35,6 +45,52 @@ app.secret_key = os.environ.get("SECRET_KEY", "dev-secret-change-me")
 UPLOAD_FOLDER = os.environ.get("UPLOAD_FOLDER", tempfile.gettempdir())
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 30 * 1024 * 1024  # 30 MB
+UPLOAD_CHUNK_SIZE = 64 * 1024
+UPLOAD_CACHE_BYTES = int(os.environ.get("UPLOAD_CACHE_BYTES", 256 * 1024 * 1024))  # PDF‑Bytes im Speicher, Rest von Platte
+PDF_CACHE_SIZE = int(os.environ.get("PDF_CACHE_SIZE", 32))  # Anzahl geparster PdfReader
+OUTPUT_SPOOL_SIZE = int(os.environ.get("OUTPUT_SPOOL_SIZE", 1024 * 1024))  # erzeugte PDFs bis 1 MB im RAM, größere in eine Temp-Datei
+
+# -------------------------
+# Upload‑Speicher (UPLOAD_FOLDER, im Prozess gecacht)
+# -------------------------
+class _LRUCache(OrderedDict):
+    """Dict mit Obergrenze: der am längsten nicht benutzte Eintrag fliegt zuerst raus.
+
+    Mit `sizeof(value)` gilt maxsize für die Summe der Größen (z.B. Bytes) statt für die Anzahl.
+    """
+
+    def __init__(self, maxsize: int, sizeof=None):
+        super().__init__()
+        self.maxsize = maxsize
+        self.sizeof = sizeof or (lambda value: 1)
+        self.size = 0
+        self.lock = threading.RLock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self:
+                return default
+            self.move_to_end(key)
+            return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        with self.lock:
+            if key in self:
+                self.size -= self.sizeof(super().__getitem__(key))
+            super().__setitem__(key, value)
+            self.size += self.sizeof(value)
+            self.move_to_end(key)
+            while self.size > self.maxsize:
+                _, evicted = self.popitem(last=False)
+                self.size -= self.sizeof(evicted)
+
+
+# Hochgeladene PDFs liegen unter UPLOAD_FOLDER/<sha1>.pdf, damit jeder Worker (gunicorn -w N) sie findet;
+# gleiche Inhalte liegen nur einmal dort. Im Speicher ist nur ein nach Bytes begrenzter Cache davon.
+# In der Session stehen nur Name und sha1 ({'name', 'stem', 'digest'}); die Feldliste entsteht aus dem PDF.
+_PDF_DATA = _LRUCache(UPLOAD_CACHE_BYTES, sizeof=len)
+# sha1 der PDF‑Bytes -> geparster PdfReader; identische Uploads teilen sich einen Eintrag
+_PDF_CACHE = _LRUCache(PDF_CACHE_SIZE)
 
 # -------------------------
 # HTML‑Templates (inline)
@@ -84,7 +140,7 @@ TPL_LAYOUT = """
 """
 
 TPL_INDEX = """
-{% extends "layout" %}
+{% extends "layout.html" %}
 {% block content %}
   <div class="card">
     <h2>1) PDF hochladen</h2>
@@ -139,225 +195,474 @@ TPL_INDEX = """
 # -------------------------
 # PDF‑Helper
 # -------------------------
+# PdfName('X') baut bei jedem Aufruf ein neues Namensobjekt -> einmal anlegen. Vergleiche bleiben ==,
+# pdfrw interniert Namen nicht (aus der Datei gelesene Namen sind eigene Objekte)
+_PN_OFF = PdfName('Off')
+_PN_YES = PdfName('Yes')
+_PN_TX = PdfName('Tx')
+_PN_BTN = PdfName('Btn')
+_PN_CH = PdfName('Ch')
+_PN_WIDGET = PdfName('Widget')
+_FF_RADIO = 1 << 15  # /Ff‑Bit 16: Button‑Feld ist eine Radio‑Gruppe
+# Feste Updates für _apply_values: Checkbox aus (V+AS in einem Rutsch), Radio‑Kind aus
+_SET_OFF = PdfDict(V=_PN_OFF, AS=_PN_OFF)
+_AS_OFF = PdfDict(AS=_PN_OFF)
+_V_OFF = PdfDict(V=_PN_OFF)
+# Formularwerte, die eine Checkbox einschalten (kleingeschrieben verglichen, True wird zu 'true')
+_TRUTHY = frozenset(('yes', 'on', '1', 'true'))
+
+def _read_raw_upload() -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Rohe PDF im Request‑Body (Content‑Type: application/pdf), z.B. `curl --data-binary @f.pdf`.
+
+    Spart das Multipart‑Parsing komplett; der Dateiname kommt aus dem Query‑Parameter `name`.
+    Rückgabe wie bei _read_upload().
+    """
+    hasher = hashlib.sha1()
+    received = False
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                hasher.update(chunk)
+                received = True
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if not received:
+        os.unlink(tmp_path)
+        return None, None, None
+    filename = secure_filename(request.args.get('name', '')) or 'upload.pdf'
+    return filename, tmp_path, hasher.hexdigest()
+
+
+def _read_upload(field: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
+    """Schreibt die Datei aus dem Multipart‑Feld `field` blockweise in eine Temp‑Datei in UPLOAD_FOLDER.
+
+    Umgeht request.files (werkzeug.formparser) und sammelt den Body nicht im Speicher.
+    MAX_CONTENT_LENGTH erzwingt request.stream selbst (413). Der sha1 wird gleich beim Empfang
+    blockweise mitgerechnet. Liefert (dateiname, temp‑pfad, sha1) oder (None, None, None), wenn
+    keine Datei mitgeschickt wurde; den Temp‑Pfad übernimmt _store_pdf().
+    """
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype == 'application/pdf':
+        return _read_raw_upload()
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        return None, None, None
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    filename = None
+    hasher = hashlib.sha1()
+    writing = False
+    fd, tmp_path = tempfile.mkstemp(dir=app.config['UPLOAD_FOLDER'], suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = request.stream.read(UPLOAD_CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+                event = decoder.next_event()
+                while not isinstance(event, (NeedData, Epilogue)):
+                    if isinstance(event, File) and event.name == field and event.filename and filename is None:
+                        filename = secure_filename(event.filename) or 'upload.pdf'
+                        writing = True
+                    elif isinstance(event, (File, Field)):
+                        writing = False  # andere Felder interessieren hier nicht
+                    elif isinstance(event, Data) and writing:
+                        out.write(event.data)
+                        hasher.update(event.data)
+                    event = decoder.next_event()
+                if not chunk:
+                    break
+    except ValueError:
+        # Kaputter Multipart‑Body
+        filename = None
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    if filename is None:
+        os.unlink(tmp_path)
+        return None, None, None
+    return filename, tmp_path, hasher.hexdigest()
+
+
+def _upload_path(digest: str) -> str:
+    return os.path.join(app.config['UPLOAD_FOLDER'], digest + '.pdf')
+
+
+def _store_pdf(digest: str, tmp_path: str, data: bytes):
+    """Benennt die empfangene Temp‑Datei atomar in UPLOAD_FOLDER/<sha1>.pdf um und legt die Bytes in den Cache.
+
+    Gibt es die Datei schon (gleicher Inhalt), wird sie ersetzt; andere Worker sehen nie eine halbe Datei.
+    """
+    os.replace(tmp_path, _upload_path(digest))
+    _PDF_DATA[digest] = data
+
+
+def _pdf_data(digest: str) -> bytes:
+    """PDF‑Bytes zum sha1: aus dem Speicher oder, z.B. im anderen Worker hochgeladen, von Platte."""
+    data = _PDF_DATA.get(digest)
+    if data is None:
+        with open(_upload_path(digest), 'rb') as f:
+            data = f.read()
+        _PDF_DATA[digest] = data
+    return data
+
+
+def _current_upload() -> Optional[dict]:
+    """Upload der aktuellen Session (oder None, wenn keiner da ist bzw. die Datei entfernt wurde)."""
+    upload = session.get('upload')
+    if not upload:
+        return None
+    if upload['digest'] not in _PDF_DATA and not os.path.exists(_upload_path(upload['digest'])):
+        return None
+    return upload
+
+
+def _get_pdf(upload: dict, data: Optional[bytes] = None) -> PdfReader:
+    """Geparster PdfReader samt Widget‑Index und Feldliste, pro Dateiinhalt einmal gebaut und geteilt.
+    Änderungen nur unter `pdf.lock` per _update(), danach _restore(); eigene Attribute über `pdf.private`."""
+    pdf = _PDF_CACHE.get(upload['digest'])
+    if pdf is None:
+        pdf = PdfReader(fdata=data if data is not None else _pdf_data(upload['digest']))
+        pdf.private.lock = threading.Lock()
+        _set_need_appearances(pdf)
+        pdf.private.widget_index, pdf.private.radio_groups, pdf.private.checkboxes = _get_acroform_fields(pdf)
+        pdf.private.fields_render = _build_fields_render(pdf.widget_index, pdf.radio_groups, pdf.checkboxes)
+        pdf.private.on_states = _find_on_states(pdf.checkboxes)
+        pdf.private.checkbox_names = frozenset(pdf.checkboxes)
+        _PDF_CACHE[upload['digest']] = pdf
+    return pdf
+
+
+def _build_fields_render(widgets: Dict[str, PdfDict], radio_groups: Dict[str, list],
+                         checkboxes: Dict[str, list]) -> List[dict]:
+    """Feldbeschreibungen fürs Formular; wird pro PDF‑Inhalt einmal in _get_pdf erzeugt und geteilt.
+
+    Ein Eintrag je Feld, bei Radio‑Gruppen einer je Option (On‑State eines Kinds).
+    """
+    fields_render = []
+    for name, w in widgets.items():
+        kids = radio_groups.get(name)
+        if kids is not None:
+            fields_render.extend(_radio_descriptors(name, w, kids))
+        elif name in checkboxes:
+            fields_render.append(_checkbox_descriptor(name, w, checkboxes[name]))
+        else:
+            fields_render.append(_field_descriptor(name, w))
+    return fields_render
+
+
+def _on_state(widget: PdfDict) -> Optional[PdfName]:
+    """On‑State eines Button‑Widgets: erster /AP /N‑Key ungleich /Off (oder None)."""
+    n_ap = widget.AP.N if widget.AP else None
+    if isinstance(n_ap, PdfDict):
+        return next((k for k in n_ap.keys() if k != _PN_OFF), None)
+    return None
+
+
+def _find_on_states(checkboxes: Dict[str, list]) -> Dict[str, PdfName]:
+    """On‑State je Checkbox: der erste ihrer Widgets; Checkboxen ohne /AP /N‑On‑State fehlen (dann gilt /Yes)."""
+    on_states = {}
+    for name, kids in checkboxes.items():
+        on_state = next((state for _, state in kids if state is not None), None)
+        if on_state is not None:
+            on_states[name] = on_state
+    return on_states
+
+
+def _update(obj: PdfDict, saved: List[Tuple[PdfDict, dict]], entries: PdfDict):
+    """Setzt `entries` auf obj und merkt sich vorher nur deren alte Rohwerte in `saved` (für _restore).
+
+    `entries` ist ein fertiges PdfDict, damit feste Kombinationen (_SET_OFF, _AS_OFF) nur einmal
+    angelegt werden und alle Keys eines Widgets in einem update() landen.
+    """
+    saved.append((obj, {key: dict.get(obj, key) for key in entries}))
+    obj.update(entries)
+
+
+def _restore(saved: List[Tuple[PdfDict, dict]]):
+    # rückwärts: wurde ein Key mehrfach gesetzt, gewinnt am Ende der ursprüngliche Wert
+    for obj, old in reversed(saved):
+        for key, value in old.items():
+            if value is None:
+                dict.pop(obj, key, None)
+            else:
+                dict.__setitem__(obj, key, value)
+
+
+def _pdfstr(v) -> Optional[str]:
+    """PDF‑String → str; PdfString über to_unicode() (Klammern, Escapes, UTF‑16), sonst str()."""
+    if isinstance(v, PdfString):
+        return v.to_unicode()
+    return str(v).strip('()') if v else None
+
+
+def _iter_widgets(pdf):
+    """Alle Widget‑Annotationen des Formulars.
 
-def _get_acroform_fields(pdf) -> Tuple[Dict[str, PdfDict], Dict[str, str]]:
-    """Liest alle Formularfelder (AcroForm). Liefert map: name->widget sowie zusätzliche Radio‑Gruppen.
+    Normalerweise über den Feldbaum /AcroForm /Fields (/Kids rekursiv) – das berührt nur
+    Formularfelder, nicht Links, Stempel & Co. auf allen Seiten. Fehlt /Fields (z.B. PDFs, deren
+    Widgets nur in den Seiten‑/Annots hängen), werden stattdessen die Seiten durchlaufen.
+    """
+    root_fields = pdf.Root.AcroForm.Fields
+    if not root_fields:
+        for page in pdf.pages:
+            annots = page.Annots
+            if not annots:
+                # Seiten ohne Annotationen (bei gescannten Formularen fast alle) gar nicht erst anfassen
+                continue
+            for annot in annots:
+                if annot.Subtype == _PN_WIDGET:
+                    yield annot
+        return
+    stack = list(reversed(root_fields))
+    seen = set()  # kaputte PDFs können Zyklen in /Kids haben
+    while stack:
+        node = stack.pop()
+        if node is None or id(node) in seen:
+            continue
+        seen.add(id(node))
+        if node.Subtype == _PN_WIDGET:
+            yield node
+        kids = node.Kids
+        if kids:
+            stack.extend(reversed(kids))
+
+
+def _inherited(node: PdfDict, key: str):
+    """Vererbbarer Feld‑Key (/FT, /Ff, …): am Widget selbst oder am nächsten Eltern‑Feld."""
+    for _ in range(32):  # Schutz gegen Zyklen in /Parent
+        if node is None:
+            return None
+        value = getattr(node, key)
+        if value is not None:
+            return value
+        node = node.Parent
+    return None
+
+
+def _get_acroform_fields(pdf) -> Tuple[Dict[str, PdfDict], Dict[str, list], Dict[str, list]]:
+    """Liest alle Formularfelder (AcroForm). Liefert map: name->widget sowie Radio‑Gruppen und Checkboxen.
+
+    Eine Radio‑Gruppe ist das Eltern‑Feld der Radio‑Widgets; in `fields` steht es unter dem
+    Gruppennamen (für die Reihenfolge), in `radio_groups` dessen /Kids als (Widget, On‑State).
+    Checkbox‑Widgets ohne eigenes /T gehören ebenso zum Eltern‑Feld; `checkboxes` listet je
+    Checkbox alle ihre Widgets als (Widget, On‑State).
     """
     fields = {}
-    radio_groups = {}  # key: group name -> export name that is currently selected
+    radio_groups = {}  # group name -> [(kid widget, on-state), ...]
+    checkboxes = {}  # checkbox name -> [(widget, on-state), ...]
 
     if not pdf:
-        return fields, radio_groups
+        return fields, radio_groups, checkboxes
 
     # Ensure AcroForm dict exists
-    if not getattr(pdf.Root, 'AcroForm', None):
-        return fields, radio_groups
-
-    for page in pdf.pages:
-        annots = getattr(page, 'Annots', []) or []
-        for annot in annots:
-            if annot.get('/Subtype') != PdfName('Widget'):
-                continue
-            name = (annot.get('/T') or '').strip('()') if annot.get('/T') else None
-            field_type = annot.get('/FT')
-            if not name and field_type == PdfName('Btn'):
-                # Radios sometimes without /T, belong to a parent
-                parent = annot.get('/Parent')
-                if parent and parent.get('/T'):
-                    name = parent.get('/T').strip('()')
+    if not pdf.Root.AcroForm:
+        return fields, radio_groups, checkboxes
+
+    for annot in _iter_widgets(pdf):
+        parent = annot.Parent
+        if _inherited(annot, 'FT') == _PN_BTN and int(_inherited(annot, 'Ff') or 0) & _FF_RADIO:
+            # Radio: Kinder meist ohne eigenes /T und /FT → über die Eltern gruppieren, einmal pro Gruppe
+            group = parent if parent is not None else annot
+            name = _pdfstr(group.T)
+            if name and name not in radio_groups:
+                kids = group.Kids if parent is not None else [annot]
+                radio_groups[name] = [(kid, _on_state(kid)) for kid in kids]
+                fields[name] = group
+            continue
+        name = _pdfstr(annot.T)
+        if _inherited(annot, 'FT') == _PN_BTN:
+            # Checkbox; ein Widget ohne /T (mit oder ohne eigenes /FT) gehört zum Eltern‑Feld, das /V trägt
+            field = annot
+            if not name and parent is not None:
+                field = parent
+                name = _pdfstr(parent.T)
             if not name:
                 continue
-            fields[name] = annot
-
-            # Track radio groups current value via /V on parent
-            if field_type == PdfName('Btn'):
-                parent = annot.get('/Parent')
-                if parent and parent.get('/V'):
-                    v = parent.get('/V')
-                    if isinstance(v, PdfName):
-                        radio_groups[parent.get('/T').strip('()')] = v[1:]  # remove leading '/'
+            fields[name] = field
+            checkboxes.setdefault(name, []).append((annot, _on_state(annot)))
+            continue
+        if not name:
+            continue
+        fields[name] = annot
 
-    return fields, radio_groups
+    return fields, radio_groups, checkboxes
 
 
-def _field_descriptor(name: str, widget: PdfDict, radio_selected: Dict[str, str]):
-    ft = widget.get('/FT')
-    label = widget.get('/TU') or name  # Prefer tooltip/alternate name if present
+def _field_descriptor(name: str, widget: PdfDict):
+    ft = _inherited(widget, 'FT')
+    label = _pdfstr(widget.TU) or name  # Prefer tooltip/alternate name if present
 
-    if ft == PdfName('Tx'):
-        value = widget.get('/V')
-        if isinstance(value, PdfObject):
-            value = str(value).strip('()')
+    if ft == _PN_TX:
+        value = _pdfstr(widget.V)
         return { 'type': 'text', 'name': name, 'label': label, 'value': value }
 
-    if ft == PdfName('Btn'):
-        # Distinguish checkbox vs radio by /Parent and /Kids
-        # Checkbox: has /V on the widget; radio: value on parent group
-        parent = widget.get('/Parent')
-        ap = widget.get('/AP')
-        n_ap = ap.get('/N') if ap else None
-        export_states = []
-        if isinstance(n_ap, PdfDict):
-            export_states = [k[1:] for k in n_ap.keys() if isinstance(k, PdfName) and k != PdfName('Off')]
-
-        if parent and parent.get('/FT') == PdfName('Btn') and parent.get('/Kids'):
-            group = parent.get('/T').strip('()') if parent.get('/T') else name
-            selected = radio_selected.get(group) == (widget.get('/AS')[1:] if isinstance(widget.get('/AS'), PdfName) else None)
-            return { 'type': 'radio', 'group': group, 'name': name, 'label': label, 'selected': selected }
-        else:
-            # Checkbox
-            v = widget.get('/V')
-            is_checked = False
-            if isinstance(v, PdfName):
-                is_checked = (v != PdfName('Off'))
-            elif isinstance(widget.get('/AS'), PdfName):
-                is_checked = (widget.get('/AS') != PdfName('Off'))
-            return { 'type': 'checkbox', 'name': name, 'label': label, 'value': 'Yes' if is_checked else 'Off' }
-
-    if ft == PdfName('Ch'):
+    if ft == _PN_CH:
         # Choice (dropdown)
-        opts_raw = widget.get('/Opt')
+        opts_raw = widget.Opt
         options: List[str] = []
         if isinstance(opts_raw, list):
             for o in opts_raw:
-                s = str(o)
-                s = s.strip('()')
-                options.append(s)
-        value = widget.get('/V')
-        if isinstance(value, PdfObject):
-            value = str(value).strip('()')
+                options.append(_pdfstr(o))
+        value = _pdfstr(widget.V)
         return { 'type': 'choice', 'name': name, 'label': label, 'options': options, 'value': value }
 
     # Fallback: treat as text
     return { 'type': 'text', 'name': name, 'label': label, 'value': None }
 
 
+def _checkbox_descriptor(name: str, field: PdfDict, kids: list) -> dict:
+    """Checkbox; Zustand aus /V am Feld, sonst aus /AS ihrer Widgets."""
+    v = field.V
+    # PdfName ist eine Factory, kein Typ → gegen BasePdfName prüfen
+    if isinstance(v, BasePdfName):
+        is_checked = (v != _PN_OFF)
+    else:
+        is_checked = any(isinstance(kid.AS, BasePdfName) and kid.AS != _PN_OFF for kid, _ in kids)
+    label = _pdfstr(field.TU) or name
+    return { 'type': 'checkbox', 'name': name, 'label': label, 'value': 'Yes' if is_checked else 'Off' }
+
+
+def _radio_descriptors(group: str, field: PdfDict, kids: list) -> List[dict]:
+    """Eine Option je Kind; der Wert im Formular ist der On‑State (Exportwert) ohne führendes '/'."""
+    v = field.V
+    selected = v[1:] if isinstance(v, BasePdfName) else None
+    group_label = _pdfstr(field.TU) or group
+    return [{ 'type': 'radio', 'group': group, 'name': state[1:], 'label': _pdfstr(kid.TU) or group_label,
+              'selected': state[1:] == selected }
+            for kid, state in kids if state is not None]
+
+
 def _set_need_appearances(pdf):
     if not getattr(pdf.Root, 'AcroForm', None):
         pdf.Root.AcroForm = PdfDict()
     pdf.Root.AcroForm.update(PdfDict(NeedAppearances=PdfObject('true')))
 
 
-def _apply_values(pdf, values: Dict[str, str]):
-    fields, _ = _get_acroform_fields(pdf)
-    for name, widget in fields.items():
-        if name not in values:
+def _set_checkbox(pdf, name: str, checked: bool, saved: List[Tuple[PdfDict, dict]]):
+    """/V am Feld, /AS an jedem Widget der Checkbox.
+
+    Ist das Feld ein Eltern‑Feld, bekommt es nur /V. Eingeschaltet gehen die Widgets mit dem
+    On‑State der Checkbox (ohne /AP /N gilt /Yes) auf diesen State, alle anderen auf /Off.
+    """
+    field = pdf.widget_index[name]
+    is_widget = field.Subtype == _PN_WIDGET
+    if not checked:
+        _update(field, saved, _SET_OFF if is_widget else _V_OFF)
+        for kid, _ in pdf.checkboxes[name]:
+            if kid is not field:
+                _update(kid, saved, _AS_OFF)
+        return
+    on_state = pdf.on_states.get(name, _PN_YES)
+    _update(field, saved, PdfDict(V=on_state, AS=on_state) if is_widget else PdfDict(V=on_state))
+    as_on = PdfDict(AS=on_state)
+    for kid, state in pdf.checkboxes[name]:
+        if kid is not field:
+            _update(kid, saved, as_on if state in (None, on_state) else _AS_OFF)
+
+
+def _apply_values(pdf, values: Mapping[str, str], saved: List[Tuple[PdfDict, dict]]):
+    """Setzt die gesendeten Werte; Checkboxen ohne Wert (abgewählt, also nicht gesendet) gehen auf /Off."""
+    fields = pdf.widget_index  # einmalig in _get_pdf aufgebaut
+    radio_groups = pdf.radio_groups
+    for name, v in values.items():
+        kids = radio_groups.get(name)
+        if kids is not None:
+            # Radio: das Formular schickt <Gruppe>=<On‑State>; passt kein Kind, bleibt die Gruppe unverändert
+            on_state = next((state for _, state in kids if state is not None and state[1:] == v), None)
+            if on_state is None:
+                continue
+            _update(fields[name], saved, PdfDict(V=on_state))
+            as_on = PdfDict(AS=on_state)
+            for kid, state in kids:
+                _update(kid, saved, as_on if state == on_state else _AS_OFF)
             continue
-        v = values[name]
-        ft = widget.get('/FT')
-        if ft == PdfName('Tx'):
-            widget.update(PdfDict(V=str(v)))
-        elif ft == PdfName('Btn'):
-            parent = widget.get('/Parent')
-            ap = widget.get('/AP')
-            n_ap = ap.get('/N') if ap else None
-            # Determine on‑state name (export value)
-            on_state = None
-            if isinstance(n_ap, PdfDict):
-                for k in n_ap.keys():
-                    if isinstance(k, PdfName) and k != PdfName('Off'):
-                        on_state = k
-                        break
-            # Checkbox
-            if not (parent and parent.get('/Kids')):
-                if v in ('Yes', 'On', '1', True, 'true', 'TRUE', 'yes'):
-                    if on_state is None:
-                        on_state = PdfName('Yes')
-                    widget.update(PdfDict(V=on_state, AS=on_state))
-                else:
-                    widget.update(PdfDict(V=PdfName('Off'), AS=PdfName('Off')))
-            else:
-                # Radio: set group value on parent and appearance state on widgets
-                group_value = PdfName(values.get(parent.get('/T').strip('()'), '')) if parent.get('/T') else None
-                # If user sent radio via group key, map selection back to this widget name
-                selected_widget_name = values.get(parent.get('/T').strip('()')) if parent and parent.get('/T') else None
-                if selected_widget_name == name:
-                    # Set parent value to this widget's on state
-                    if on_state is None:
-                        on_state = PdfName('Yes')
-                    parent.update(PdfDict(V=on_state))
-                    widget.update(PdfDict(AS=on_state))
-                else:
-                    # Others off
-                    widget.update(PdfDict(AS=PdfName('Off')))
-        elif ft == PdfName('Ch'):
-            widget.update(PdfDict(V=str(v)))
+        if name in pdf.checkbox_names:
+            # Checkbox; über den Namen statt /FT, das kann auch nur an den Kind‑Widgets stehen
+            _set_checkbox(pdf, name, str(v).lower() in _TRUTHY, saved)
+            continue
+        widget = fields.get(name)
+        if widget is None:
+            continue
+        ft = _inherited(widget, 'FT')
+        if ft == _PN_TX:
+            _update(widget, saved, PdfDict(V=str(v)))
+        elif ft == _PN_CH:
+            _update(widget, saved, PdfDict(V=str(v)))
+    # Abgewählte Checkboxen tauchen nicht in values auf → per Mengendifferenz direkt ausschalten
+    for name in pdf.checkbox_names - values.keys():
+        _set_checkbox(pdf, name, False, saved)
 
 # -------------------------
 # Routes
 # -------------------------
 @app.route('/')
 def index():
-    fields = session.get('fields_render', [])
-    return render_template_string(TPL_INDEX, fields=fields)
+    upload = _current_upload()
+    fields = _get_pdf(upload).fields_render if upload else []
+    return render_template('index.html', fields=fields)
 
 @app.route('/upload', methods=['POST'])
 def upload():
-    f = request.files.get('pdf')
-    if not f or f.filename == '':
+    filename, tmp_path, digest = _read_upload('pdf')
+    if tmp_path is None:
         flash('Keine Datei ausgewählt.')
         return redirect(url_for('index'))
 
-    filename = secure_filename(f.filename)
-    temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    f.save(temp_path)
-
+    # Basis des Download‑Namens einmal pro Upload statt bei jedem /fill
+    upload = {'name': filename, 'stem': os.path.splitext(filename)[0], 'digest': digest}
     try:
-        pdf = PdfReader(temp_path)
+        with open(tmp_path, 'rb') as f:
+            data = f.read()
+        pdf = _get_pdf(upload, data)
     except Exception as e:
+        os.unlink(tmp_path)
         flash(f'PDF konnte nicht gelesen werden: {e}')
         return redirect(url_for('index'))
 
-    # NeedAppearances setzen (für Anzeige in Viewern)
-    _set_need_appearances(pdf)
-
-    widgets, radio_selected = _get_acroform_fields(pdf)
-
-    fields_render = []
-    radio_added = set()  # vermeide doppelte Radios
-    for name, w in widgets.items():
-        desc = _field_descriptor(name, w, radio_selected)
-        if desc['type'] == 'radio':
-            key = (desc['group'], desc['name'])
-            if key in radio_added:
-                continue
-            radio_added.add(key)
-        fields_render.append(desc)
+    # NeedAppearances, Widget‑Index und Feldliste hat _get_pdf bereits (pro Dateiinhalt einmal) erzeugt
+    fields_render = pdf.fields_render
 
     # Speichern für nächsten Schritt
-    session['pdf_path'] = temp_path
-    session['fields_render'] = fields_render
+    _store_pdf(digest, tmp_path, data)
+    session['upload'] = upload
 
     flash(f"{len(fields_render)} Feld(er) erkannt in {filename}.")
     return redirect(url_for('index'))
 
 @app.route('/fill', methods=['POST'])
 def fill():
-    pdf_path = session.get('pdf_path')
-    if not pdf_path or not os.path.exists(pdf_path):
+    upload = _current_upload()
+    if not upload:
         flash('Sitzung abgelaufen. Bitte PDF erneut hochladen.')
         return redirect(url_for('index'))
 
-    # Form‑Werte einsammeln
-    values: Dict[str, str] = {}
-    for k, v in request.form.items():
-        values[k] = v
-
-    # Checkboxen, die abgewählt sind, tauchen nicht in request.form auf → anhand gespeicherter Felder vervollständigen
-    for f in session.get('fields_render', []):
-        if f['type'] == 'checkbox' and f['name'] not in values:
-            values[f['name']] = 'Off'
-
-    pdf = PdfReader(pdf_path)
-    _set_need_appearances(pdf)
-    _apply_values(pdf, values)
-
-    # Ausgabe ins Memory und Download anbieten
-    out_io = io.BytesIO()
-    PdfWriter().write(out_io, pdf)
+    pdf = _get_pdf(upload)
+
+    out_io = tempfile.SpooledTemporaryFile(max_size=OUTPUT_SPOOL_SIZE)
+    with pdf.lock:
+        # _apply_values ändert Widgets und Radio‑Eltern des gecachten Readers; gesichert werden
+        # nur die tatsächlich gesetzten Keys (/V, /AS) statt Kopien aller Widget‑Dicts
+        saved: List[Tuple[PdfDict, dict]] = []
+        try:
+            _apply_values(pdf, request.form, saved)
+            # Ausgabe ins Memory und Download anbieten
+            PdfWriter().write(out_io, pdf)
+        finally:
+            _restore(saved)
+    size = out_io.tell()
     out_io.seek(0)
+    if size <= OUTPUT_SPOOL_SIZE:
+        # noch nicht ausgelagert: als BytesIO senden. Ein wsgi.file_wrapper (gunicorn) ruft sonst fileno()
+        # auf, und das schreibt die SpooledTemporaryFile doch noch auf Platte
+        out_io = io.BytesIO(out_io.read())
 
-    out_name = os.path.splitext(os.path.basename(pdf_path))[0] + "_ausgefuellt.pdf"
+    out_name = upload['stem'] + "_ausgefuellt.pdf"
     return send_file(out_io, as_attachment=True, download_name=out_name, mimetype='application/pdf')
 
 # -------------------------
@@ -367,10 +672,13 @@ def fill():
 def inject_templates():
     return {}
 
-@app.before_request
-def ensure_templates_loaded():
-    # Register layout each request (einfach gehalten, kein separates Templating‑File)
-    app.jinja_env.globals['layout'] = app.jinja_env.from_string(TPL_LAYOUT)
+# Einmal beim Import registriert (.html-Namen -> Autoescape wie zuvor); Jinja kompiliert jedes Template beim ersten Zugriff und hält es im Cache
+app.jinja_loader = DictLoader({
+    "layout.html": TPL_LAYOUT,
+    "index.html": TPL_INDEX,
+})
+# Die Templates sind Modul-Strings und ändern sich zur Laufzeit nie -> keine uptodate-Prüfung pro Render
+app.jinja_env.auto_reload = False
 
 # -------------------------
 # Optional: Flatten‑Hilfsfunktion (CLI‑Beispiel)